@@ -1,3 +1,4 @@
+import functools
 import math
 import time
 import traceback
@@ -13,23 +14,38 @@ CMD_DESC = "Cycloidal reducer sketches (dual disc, aligned output holes)."
 CLEARANCE_MM = 0.10
 HOLE_EXTRA_DIAM_MM = 0.30
 
-def _mm_to_cm(v): return v / 10.0
 def _cm_to_mm(v): return v * 10.0
 
-def _p3(x_mm, y_mm):
-    return adsk.core.Point3D.create(_mm_to_cm(x_mm), _mm_to_cm(y_mm), 0.0)
-
-def _rot(x, y, a):
-    ca, sa = math.cos(a), math.sin(a)
-    return (x * ca - y * sa, x * sa + y * ca)
-
 def _add_circle(sk, cx_mm, cy_mm, r_mm):
-    return sk.sketchCurves.sketchCircles.addByCenterRadius(_p3(cx_mm, cy_mm), _mm_to_cm(r_mm))
+    return sk.sketchCurves.sketchCircles.addByCenterRadius(adsk.core.Point3D.create(cx_mm * 0.1, cy_mm * 0.1, 0.0), r_mm * 0.1)
+
+def _add_circles(sk, centers_mm, r_mm, offset_mm=(0.0, 0.0)):
+    add = sk.sketchCurves.sketchCircles.addByCenterRadius
+    create = adsk.core.Point3D.create
+    ox, oy = offset_mm[0] * 0.1, offset_mm[1] * 0.1
+    r = r_mm * 0.1
+    for x, y in centers_mm:
+        add(create(x * 0.1 + ox, y * 0.1 + oy, 0.0), r)
+
+def _add_spline(sk, pts_mm, closed=True, rot_cs=(1.0, 0.0), offset_mm=(0.0, 0.0)):
+    # Rotation, offset and mm->cm scale are folded into one affine map so
+    # each point is transformed and handed to Fusion in a single pass.
+    ca, sa = 0.1 * rot_cs[0], 0.1 * rot_cs[1]
+    ox, oy = offset_mm[0] * 0.1, offset_mm[1] * 0.1
+
+    create = adsk.core.Point3D.create
+    pts = [create(x * ca - y * sa + ox, x * sa + y * ca + oy, 0.0) for x, y in pts_mm]
+
+    # createWithArray fills the collection in one API call; older Fusion
+    # builds without it fall back to one add() per point.
+    make_coll = getattr(adsk.core.ObjectCollection, "createWithArray", None)
+    if make_coll:
+        coll = make_coll(pts)
+    else:
+        coll = adsk.core.ObjectCollection.create()
+        for pt in pts:
+            coll.add(pt)
 
-def _add_spline(sk, pts_mm, closed=True):
-    coll = adsk.core.ObjectCollection.create()
-    for x, y in pts_mm:
-        coll.add(_p3(x, y))
     sp = sk.sketchCurves.sketchFittedSplines.add(coll)
     sp.isClosed = bool(closed)
     return sp
@@ -38,6 +54,26 @@ def _phase_deg_auto(N):
     lobes = N - 1
     return 180.0 / lobes if lobes > 0 else 0.0
 
+def _max_curvature(N, ring_pcd, ecc):
+    # Base curvature depends on p only through u = cos((N - 1) p):
+    # k(u) = (a - b u) / (c - g u)^1.5, which has a single stationary point
+    # u*, so its maximum over [-1, 1] is at u* or an endpoint.
+    R = ring_pcd / 2.0
+    eN = ecc * N
+    a = R * R + eN * eN * N
+    b = R * eN * (N + 1)
+    c = R * R + eN * eN
+    g = 2.0 * R * eN
+
+    u_star = max(-1.0, min(1.0, (1.5 * g * a - b * c) / (0.5 * g * b)))
+    return max((a - b * u) / (c - g * u) ** 1.5 for u in (-1.0, u_star, 1.0))
+
+def _offset_is_loop_free(N, ring_pcd, ecc, d_eff):
+    # An inward offset cannot form a swallowtail while it stays inside the
+    # tightest convex radius of the base curve.
+    return d_eff * _max_curvature(N, ring_pcd, ecc) < 1.0
+
+@functools.lru_cache(maxsize=128)
 def _validate(N, ring_pcd, pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d):
     if N < 3: return False, "N must be >= 3"
     if ring_pcd <= 0 or pin_d <= 0: return False, "Ring PCD / pin dia must be > 0"
@@ -57,8 +93,69 @@ def _validate(N, ring_pcd, pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d):
     if (pin_d / 2.0 + CLEARANCE_MM) >= R:
         return False, "Clearance too large vs ring radius"
 
+    if not _offset_is_loop_free(N, ring_pcd, ecc, pin_d / 2.0 + CLEARANCE_MM):
+        return False, "Disc profile undercuts (reduce pin dia or E)"
+
     return True, ""
 
+def _curvature_params(N, R, ecc, d_eff, steps):
+    # Half the sample budget is spread by arc length of the offset curve and
+    # half by sqrt(curvature) (equal chord sag), so lobe tips get more points
+    # and the flat flanks fewer.
+    cos, sin, sqrt = math.cos, math.sin, math.sqrt
+    eN = ecc * N
+    eNN = eN * N
+
+    dense = 2 * steps
+    dp = 2.0 * math.pi / dense
+
+    # Uniform steps: advance e^(ip) and e^(iNp) by a fixed rotation instead
+    # of calling trig per sample. Drift stays ~1e-13 and only feeds weights.
+    z = zN = 1.0 + 0.0j
+    step1 = complex(cos(dp), sin(dp))
+    stepN = complex(cos(N * dp), sin(N * dp))
+
+    arc = []
+    sag = []
+    for _ in range(dense):
+        cp, sp = z.real, z.imag
+        cNp, sNp = zN.real, zN.imag
+        z *= step1
+        zN *= stepN
+
+        dxa = -R * sp + eN * sNp
+        dya =  R * cp - eN * cNp
+        ddxa = -R * cp + eNN * cNp
+        ddya = -R * sp + eNN * sNp
+
+        s2 = dxa * dxa + dya * dya
+        c = (dxa * ddya - dya * ddxa) / s2
+        so = abs(sqrt(s2) - d_eff * c)
+        arc.append(so)
+        sag.append(sqrt(abs(c) * so))
+
+    ka = 0.5 / sum(arc)
+    ks = 0.5 / sum(sag)
+    w = [ka * a + ks * g for a, g in zip(arc, sag)]
+    w.append(w[0])
+
+    cum = [0.0]
+    for i in range(dense):
+        cum.append(cum[-1] + 0.5 * (w[i] + w[i + 1]))
+
+    params = []
+    j = 0
+    du = cum[-1] / steps
+    for k in range(steps):
+        u = du * k
+        while cum[j + 1] < u:
+            j += 1
+        t = (u - cum[j]) / (cum[j + 1] - cum[j])
+        params.append(dp * (j + t))
+
+    return params
+
+@functools.lru_cache(maxsize=8)
 def _trochoid_parallel_pts(N, ring_pcd, ecc, d_eff, pts_per_lobe):
     R = ring_pcd / 2.0
     lobes = N - 1
@@ -66,54 +163,51 @@ def _trochoid_parallel_pts(N, ring_pcd, ecc, d_eff, pts_per_lobe):
     pts_per_lobe = max(8, min(120, int(pts_per_lobe)))
     steps = max(240, min(1800, lobes * pts_per_lobe))
 
-    pts = []
-    prev_nx = None
-    prev_ny = None
-
-    for i in range(steps):
-        p = 2.0 * math.pi * i / steps
+    cos, sin, sqrt = math.cos, math.sin, math.sqrt
+    eN = ecc * N
 
-        xa = R * math.cos(p) - ecc * math.cos(N * p)
-        ya = R * math.sin(p) - ecc * math.sin(N * p)
+    # With E*N < R (checked by _validate) |tangent| >= R - E*N > 0, so the
+    # left normal is continuous and needs no zero-length or orientation guard.
+    pts = []
 
-        dxa = -R * math.sin(p) + (ecc * N) * math.sin(N * p)
-        dya =  R * math.cos(p) - (ecc * N) * math.cos(N * p)
+    for p in _curvature_params(N, R, ecc, d_eff, steps):
+        cp, sp = cos(p), sin(p)
+        cNp, sNp = cos(N * p), sin(N * p)
 
-        s = math.hypot(dxa, dya)
-        if s < 1e-10:
-            continue
+        xa = R * cp - ecc * cNp
+        ya = R * sp - ecc * sNp
 
-        nx = -dya / s
-        ny =  dxa / s
+        dxa = -R * sp + eN * sNp
+        dya =  R * cp - eN * cNp
 
-        if prev_nx is not None and (prev_nx * nx + prev_ny * ny) < 0.0:
-            nx, ny = -nx, -ny
+        s = sqrt(dxa * dxa + dya * dya)
+        k = d_eff / s
+        pts.append((xa - k * dya, ya + k * dxa))
 
-        prev_nx, prev_ny = nx, ny
-        pts.append((xa + d_eff * nx, ya + d_eff * ny))
+    return tuple(pts)
 
-    return pts
+@functools.lru_cache(maxsize=64)
+def _unit_pattern(n):
+    a = 2.0 * math.pi / n
+    return tuple((math.cos(a * i), math.sin(a * i)) for i in range(n))
 
 def _pattern_pts(n, pcd):
     r = pcd / 2.0
-    return [(r * math.cos(2 * math.pi * i / n), r * math.sin(2 * math.pi * i / n)) for i in range(n)]
+    return [(r * c, r * s) for (c, s) in _unit_pattern(n)]
 
-def _build_disc(sketches, plane, name, center_mm, profile_local_pts, profile_rot_rad, holes_world_pts, hole_r, bore_r):
+def _build_disc(sketches, plane, name, center_mm, profile_local_pts, profile_rot_cs, holes_local_pts, hole_r, bore_r):
     sk = sketches.add(plane)
     sk.name = name
     sk.isComputeDeferred = True
     try:
         cx, cy = center_mm
 
-        prof = [_rot(x, y, profile_rot_rad) for (x, y) in profile_local_pts]
-        prof_world = [(x + cx, y + cy) for (x, y) in prof]
-        _add_spline(sk, prof_world, closed=True)
+        _add_spline(sk, profile_local_pts, closed=True, rot_cs=profile_rot_cs, offset_mm=center_mm)
 
         if bore_r > 0:
             _add_circle(sk, cx, cy, bore_r)
 
-        for (hx, hy) in holes_world_pts:
-            _add_circle(sk, hx, hy, hole_r)
+        _add_circles(sk, holes_local_pts, hole_r, offset_mm=center_mm)
     finally:
         sk.isComputeDeferred = False
 
@@ -130,52 +224,58 @@ def _generate(design, rr, ring_pcd, ring_pin_d, ecc, pts_per_lobe, out_n, out_pi
 
     phase_deg = _phase_deg_auto(N)
     phase = math.radians(phase_deg)
+    phase_cs = (math.cos(phase), math.sin(phase))
+
+    d_eff = ring_pin_d / 2.0 + CLEARANCE_MM
+    profile_local = _trochoid_parallel_pts(N, ring_pcd, ecc, d_eff, pts_per_lobe)
+
+    # Output holes sit on the output-pin pattern in disc-local coordinates.
+    ring_pts = _pattern_pts(N, ring_pcd)
+    holes_local = _pattern_pts(out_n, out_pcd)
+
+    hole_r = (out_pin_d / 2.0) + ecc + (HOLE_EXTRA_DIAM_MM / 2.0)
+    bore_r = bore_d / 2.0 if bore_d > 0 else 0.0
 
     stamp = time.strftime("%H%M%S")
     prefix = f"CY_{stamp}"
 
     sk_ring = sketches.add(plane)
     sk_ring.name = f"{prefix}_RingPins"
-    sk_ring.isComputeDeferred = True
-    try:
-        R = ring_pcd / 2.0
-        rr_pin = ring_pin_d / 2.0
-        for i in range(N):
-            a = 2.0 * math.pi * i / N
-            _add_circle(sk_ring, R * math.cos(a), R * math.sin(a), rr_pin)
-    finally:
-        sk_ring.isComputeDeferred = False
-
     sk_out = sketches.add(plane)
     sk_out.name = f"{prefix}_OutputPins"
+
+    sk_ring.isComputeDeferred = True
     sk_out.isComputeDeferred = True
     try:
-        pr = out_pcd / 2.0
-        rr_out = out_pin_d / 2.0
-        for i in range(out_n):
-            a = 2.0 * math.pi * i / out_n
-            _add_circle(sk_out, pr * math.cos(a), pr * math.sin(a), rr_out)
+        _add_circles(sk_ring, ring_pts, ring_pin_d / 2.0)
+        _add_circles(sk_out, holes_local, out_pin_d / 2.0)
     finally:
+        sk_ring.isComputeDeferred = False
         sk_out.isComputeDeferred = False
 
-    d_eff = ring_pin_d / 2.0 + CLEARANCE_MM
-    profile_local = _trochoid_parallel_pts(N, ring_pcd, ecc, d_eff, pts_per_lobe)
-
-    hole_r = (out_pin_d / 2.0) + ecc + (HOLE_EXTRA_DIAM_MM / 2.0)
-    bore_r = bore_d / 2.0 if bore_d > 0 else 0.0
-
-    holes_local = _pattern_pts(out_n, out_pcd)
-
     c1 = (ecc, 0.0)
-    holes1_world = [(c1[0] + hx, c1[1] + hy) for (hx, hy) in holes_local]
-    _build_disc(sketches, plane, f"{prefix}_Disc1", c1, profile_local, 0.0, holes1_world, hole_r, bore_r)
+    _build_disc(sketches, plane, f"{prefix}_Disc1", c1, profile_local, (1.0, 0.0), holes_local, hole_r, bore_r)
 
     if not dual:
         return
 
     c2 = (-ecc, 0.0) if opposed else (ecc, 0.0)
-    holes2_world = [(c2[0] + hx, c2[1] + hy) for (hx, hy) in holes_local]
-    _build_disc(sketches, plane, f"{prefix}_Disc2_{phase_deg:.3f}deg", c2, profile_local, phase, holes2_world, hole_r, bore_r)
+    _build_disc(sketches, plane, f"{prefix}_Disc2_{phase_deg:.3f}deg", c2, profile_local, phase_cs, holes_local, hole_r, bore_r)
+
+def _read_inputs(ins):
+    # Dialog values in _validate's argument order (lengths in mm).
+    N = int(ins.itemById("rr").value) + 1
+
+    ring_pcd = _cm_to_mm(ins.itemById("ring_pcd").value)
+    ring_pin_d = _cm_to_mm(ins.itemById("ring_pin_d").value)
+    ecc = _cm_to_mm(ins.itemById("ecc").value)
+
+    out_n = int(ins.itemById("out_n").value)
+    out_pin_d = _cm_to_mm(ins.itemById("out_pin_d").value)
+    out_pcd = _cm_to_mm(ins.itemById("out_pcd").value)
+    bore_d = max(0.0, _cm_to_mm(ins.itemById("bore_d").value))
+
+    return (N, ring_pcd, ring_pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d)
 
 class _OnCreate(adsk.core.CommandCreatedEventHandler):
     def notify(self, args):
@@ -218,19 +318,10 @@ class _OnCreate(adsk.core.CommandCreatedEventHandler):
 
     def _update_status(self, ins):
         try:
-            rr = int(ins.itemById("rr").value)
-            N = rr + 1
-
-            ring_pcd = _cm_to_mm(ins.itemById("ring_pcd").value)
-            ring_pin_d = _cm_to_mm(ins.itemById("ring_pin_d").value)
-            ecc = _cm_to_mm(ins.itemById("ecc").value)
+            vals = _read_inputs(ins)
+            N = vals[0]
 
-            out_n = int(ins.itemById("out_n").value)
-            out_pin_d = _cm_to_mm(ins.itemById("out_pin_d").value)
-            out_pcd = _cm_to_mm(ins.itemById("out_pcd").value)
-            bore_d = max(0.0, _cm_to_mm(ins.itemById("bore_d").value))
-
-            ok, msg = _validate(N, ring_pcd, ring_pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d)
+            ok, msg = _validate(*vals)
             phase_deg = _phase_deg_auto(N)
 
             st = ins.itemById("status")
@@ -242,11 +333,18 @@ class _OnCreate(adsk.core.CommandCreatedEventHandler):
             pass
 
 class _OnChanged(adsk.core.InputChangedEventHandler):
+    def __init__(self):
+        super().__init__()
+        self._last_rr = None
+
     def notify(self, args):
         try:
             ins = args.firingEvent.sender.commandInputs
-            # cheap status refresh
+            # cheap status refresh; skip the dialog redraw if the ratio is unchanged
             rr = int(ins.itemById("rr").value)
+            if rr == self._last_rr:
+                return
+            self._last_rr = rr
             N = rr + 1
             phase_deg = _phase_deg_auto(N)
             ins.itemById("status").text = f"N={N} | Phase={phase_deg:.3f}deg"
@@ -257,20 +355,7 @@ class _OnValidate(adsk.core.ValidateInputsEventHandler):
     def notify(self, args):
         try:
             ins = args.firingEvent.sender.commandInputs
-
-            rr = int(ins.itemById("rr").value)
-            N = rr + 1
-
-            ring_pcd = _cm_to_mm(ins.itemById("ring_pcd").value)
-            ring_pin_d = _cm_to_mm(ins.itemById("ring_pin_d").value)
-            ecc = _cm_to_mm(ins.itemById("ecc").value)
-
-            out_n = int(ins.itemById("out_n").value)
-            out_pin_d = _cm_to_mm(ins.itemById("out_pin_d").value)
-            out_pcd = _cm_to_mm(ins.itemById("out_pcd").value)
-            bore_d = max(0.0, _cm_to_mm(ins.itemById("bore_d").value))
-
-            ok, _ = _validate(N, ring_pcd, ring_pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d)
+            ok, _ = _validate(*_read_inputs(ins))
             args.areInputsValid = bool(ok)
         except:
             args.areInputsValid = False
@@ -287,17 +372,10 @@ class _OnExecute(adsk.core.CommandEventHandler):
 
             ins = args.firingEvent.sender.commandInputs
 
-            rr = int(ins.itemById("rr").value)
-            ring_pcd = _cm_to_mm(ins.itemById("ring_pcd").value)
-            ring_pin_d = _cm_to_mm(ins.itemById("ring_pin_d").value)
-            ecc = _cm_to_mm(ins.itemById("ecc").value)
+            N, ring_pcd, ring_pin_d, ecc, out_n, out_pin_d, out_pcd, bore_d = _read_inputs(ins)
+            rr = N - 1
             pts_per_lobe = int(ins.itemById("pts_per_lobe").value)
 
-            out_n = int(ins.itemById("out_n").value)
-            out_pin_d = _cm_to_mm(ins.itemById("out_pin_d").value)
-            out_pcd = _cm_to_mm(ins.itemById("out_pcd").value)
-            bore_d = max(0.0, _cm_to_mm(ins.itemById("bore_d").value))
-
             dual = bool(ins.itemById("dual").value)
             opposed = bool(ins.itemById("opposed").value)
 